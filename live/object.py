@@ -21,6 +21,8 @@ class LoggingObject(object):
         print("created logger: %s" % __name__)
 
     def log_info(self, msg = "", *args):
+        if not logger.isEnabledFor(logging.INFO):
+            return
         if msg:
             msg = msg % args
         logger.info("[%s] %s", self, msg)
@@ -30,6 +32,12 @@ class LoggingObject(object):
         logger.warn("[%s] %s", self, msg)
 
     def log_debug(self, msg = "", *args):
+        #------------------------------------------------------------------------
+        # Called for every OSC message, so skip formatting unless it will
+        # actually be output.
+        #------------------------------------------------------------------------
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         msg = msg % args
         logger.debug("[%s] %s", self, msg)
 
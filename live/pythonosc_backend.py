@@ -0,0 +1,36 @@
+""" pythonosc classes used by Query when PYLIVE_BACKEND is 'pythonosc'.
+
+This module imports pythonosc, so it is only imported (by live.query's
+_load_backend()) once that backend has been selected. """
+
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import BlockingOSCUDPServer
+from pythonosc.udp_client import SimpleUDPClient
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.osc_bundle_builder import OscBundleBuilder, IMMEDIATELY
+
+__all__ = [ "BlockingOSCUDPServer", "OscMessageBuilder", "OscBundleBuilder", "IMMEDIATELY",
+            "ConnectedUDPClient", "DefaultHandlerDispatcher" ]
+
+class ConnectedUDPClient(SimpleUDPClient):
+    """ SimpleUDPClient whose socket is connected to its target once,
+    so each send() skips the kernel's per-packet route lookup. """
+
+    def __init__(self, address, port):
+        super().__init__(address, port)
+        self._sock.connect((self._address, self._port))
+
+    def send(self, content):
+        self._sock.send(content.dgram)
+
+    def send_dgram(self, dgram):
+        self._sock.send(dgram)
+
+class DefaultHandlerDispatcher(Dispatcher):
+    """ Dispatcher which passes every message straight to its default
+    handler. Query.handler() looks up the address itself, so there is
+    no need for the base class to compile each address into a regex
+    and match it against every mapped address. """
+
+    def handlers_for_address(self, address_pattern):
+        return (self._default_handler,)
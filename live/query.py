@@ -2,10 +2,20 @@ import time
 import signal
 import inspect
 import threading
+import contextlib
+import functools
+import select
+import socket
 import warnings
 import os
-
-from .object import LoggingObject
+import sys
+import struct
+import weakref
+import collections
+import logging
+import queue
+
+from .object import LoggingObject, logger
 from .exceptions import LiveConnectionError
 
 # TODO could probably refactor this import handling section a bit, to reduce the
@@ -19,45 +29,185 @@ from .exceptions import LiveConnectionError
 # people using `pylive` with `liblo` if they also happen to have `pythonosc`
 # installed. Since the pythonosc support is still a bit shaky, I don't think
 # it makes sense as a default yet.
-PYLIVE_BACKEND = os.environ.get('PYLIVE_BACKEND', 'liblo')
+PYLIVE_BACKEND = None
+OSC_BACKEND = None
+_osc_module = None
 
-supported_backends = ['pythonosc', 'liblo']
-if PYLIVE_BACKEND not in supported_backends:
-    warnings.warn('PYLIVE_BACKEND="{}" not in supported backends: {}'.format(
-        PYLIVE_BACKEND, supported_backends
-    ))
-    PYLIVE_BACKEND = 'pythonosc'
+def _load_backend():
+    """ Import the OSC backend selected by the PYLIVE_BACKEND environment
+    variable, and return its module: liblo, or live.pythonosc_backend.
+    This is deferred until the first Query is created, so that importing
+    live doesn't pay for (or require) the OSC libraries. """
+    global PYLIVE_BACKEND, OSC_BACKEND, _osc_module
 
-OSC_BACKEND = None
-if PYLIVE_BACKEND == 'pythonosc':
-    try:
-        from pythonosc.dispatcher import Dispatcher
-        from pythonosc.osc_server import ThreadingOSCUDPServer
-        from pythonosc.udp_client import SimpleUDPClient
-        OSC_BACKEND = 'pythonosc'
+    if _osc_module is not None:
+        return _osc_module
+
+    PYLIVE_BACKEND = os.environ.get('PYLIVE_BACKEND', 'liblo')
+
+    supported_backends = ['pythonosc', 'liblo']
+    if PYLIVE_BACKEND not in supported_backends:
+        warnings.warn('PYLIVE_BACKEND="{}" not in supported backends: {}'.format(
+            PYLIVE_BACKEND, supported_backends
+        ))
+        PYLIVE_BACKEND = 'pythonosc'
+
+    if PYLIVE_BACKEND == 'pythonosc':
+        try:
+            from . import pythonosc_backend
+            _osc_module = pythonosc_backend
+            OSC_BACKEND = 'pythonosc'
+
+        # TODO test this is always the right error. is it ever ModuleNotFoundError,
+        # and if so, does this match that?
+        except ImportError:
+            warnings.warn('trying PYLIVE_BACKEND=liblo because could not import '
+                'pythonosc'
+            )
+            PYLIVE_BACKEND = 'liblo'
+
+    if PYLIVE_BACKEND == 'liblo':
+        import liblo
+        _osc_module = liblo
+        OSC_BACKEND = 'liblo'
+
+    assert OSC_BACKEND is not None
+    return _osc_module
+
+#------------------------------------------------------------------------
+# Bundles are flushed before they grow beyond this many bytes, to keep
+# each one inside a single UDP packet on typical network paths.
+#------------------------------------------------------------------------
+BUNDLE_MAX_SIZE = 1200
+
+#------------------------------------------------------------------------
+# Size of the "#bundle" string and timetag at the start of every bundle.
+#------------------------------------------------------------------------
+BUNDLE_HEADER_SIZE = 16
+
+#------------------------------------------------------------------------
+# Maximum number of response addresses for which query() keeps an Event
+# around for reuse. Least recently used idle entries are discarded first.
+#------------------------------------------------------------------------
+PENDING_MAX_SIZE = 256
+
+#------------------------------------------------------------------------
+# Default size of the OSC sockets' kernel buffers, large enough to hold a
+# burst of messages while the receive thread is busy.
+#------------------------------------------------------------------------
+SOCKET_BUFFER_SIZE = 4 << 20
+
+#------------------------------------------------------------------------
+# struct formats for the fixed-size OSC argument types which can be used
+# in a PreparedCommand.
+#------------------------------------------------------------------------
+OSC_TYPE_FORMATS = { "i": "i", "f": "f", "d": "d", "h": "q" }
+
+def _osc_string(value):
+    """ Encode an OSC string: null-terminated, padded to 4 bytes. """
+    value = value.encode("utf-8")
+    return value + b"\0" * (4 - len(value) % 4)
+
+def _osc_string_size(value):
+    """ Size of an OSC string: null-terminated, padded to 4 bytes. """
+    return (len(value.encode("utf-8")) // 4 + 1) * 4
+
+def _osc_message_size(msg, args):
+    """ Estimate the serialized size of an OSC message, in bytes. """
+    size = _osc_string_size(msg) + _osc_string_size("," + "x" * len(args))
+    for arg in args:
+        if isinstance(arg, bool) or arg is None:
+            continue
+        elif isinstance(arg, str):
+            size += _osc_string_size(arg)
+        elif isinstance(arg, (bytes, bytearray)):
+            size += 4 + (len(arg) + 3) // 4 * 4
+        elif isinstance(arg, int):
+            # ints outside the 32-bit range are sent as 64-bit "h"
+            size += 4 if arg.bit_length() <= 31 else 8
+        elif isinstance(arg, float):
+            size += 4
+        else:
+            size += 8
+    return size
+
+
+class PreparedCommand(object):
+    """ A Live command with a fixed address and argument types, created with
+    Query.prepare(). Its OSC address and typetag are encoded once, so that
+    each call only needs to pack the argument values:
+
+        set_tempo = live.Query().prepare("/live/tempo", "f")
+        set_tempo(110.0)
+
+    They are not subject to cmd()'s dedup or rate limiting. """
+
+    def __init__(self, query, msg, typetags):
+        for typetag in typetags:
+            if typetag not in OSC_TYPE_FORMATS:
+                raise ValueError("Unsupported OSC type for prepared command: %s" % typetag)
+
+        self.query = query
+        self.msg = msg
+        self.typetags = typetags
+        self.struct = struct.Struct(">" + "".join(OSC_TYPE_FORMATS[typetag] for typetag in typetags))
+
+        self.header = _osc_string(msg) + _osc_string("," + typetags)
+        self.size = len(self.header) + self.struct.size
+
+    def __call__(self, *args):
+        if len(args) != len(self.typetags):
+            raise TypeError("%s takes %d arguments (%d given)" % (
+                self.msg, len(self.typetags), len(args)
+            ))
 
-    # TODO test this is always the right error. is it ever ModuleNotFoundError,
-    # and if so, does this match that?
-    except ImportError:
-        warnings.warn('trying PYLIVE_BACKEND=liblo because could not import '
-            'pythonosc'
-        )
-        PYLIVE_BACKEND = 'liblo'
+        #------------------------------------------------------------------------
+        # Packing the values first checks their types, so that a wrong one
+        # raises struct.error rather than being reported as a send failure.
+        #------------------------------------------------------------------------
+        dgram = self.header + self.struct.pack(*args)
 
-if PYLIVE_BACKEND == 'liblo':
-    import liblo
-    OSC_BACKEND = 'liblo'
+        query = self.query
+        query.log_debug("OSC output: %s %s", self.msg, args)
+        if query._bundle.messages is not None:
+            query._add_to_bundle(self.msg, args, self.typetags, self.size)
+            return
 
-assert OSC_BACKEND is not None
+        try:
+            query.osc_send_prepared(self, args, dgram)
+        except Exception as e:
+            query.log_debug(f"During {self.msg} prepared command ({args})")
+            raise LiveConnectionError("Couldn't send message to Live (is LiveOSC present and activated?)")
+
+class _BundleState(threading.local):
+    """ Commands queued by the current thread while batching: messages is
+    a list of (msg, args, typetags) tuples, or None when the thread is not
+    batching, and size is the estimated size in bytes of the bundle holding
+    them. typetags gives the OSC types of a prepared command's args, or is
+    None if the backend should infer them. """
 
+    def __init__(self):
+        self.messages = None
+        self.size = 0
 
 def singleton(cls):
     instances = {}
-    def getinstance(*args):
-        if cls not in instances:
-            instances[cls] = cls(*args)
-        return instances[cls]
-    return getinstance
+    lock = threading.Lock()
+    def getinstance(*args, **kwargs):
+        #------------------------------------------------------------------------
+        # Only lock while the instance is first being created, so that later
+        # calls don't contend.
+        #------------------------------------------------------------------------
+        instance = instances.get(cls)
+        if instance is None:
+            with lock:
+                instance = instances.get(cls)
+                if instance is None:
+                    instance = instances[cls] = cls(*args, **kwargs)
+        return instance
+
+    # keep cls's name and docstring, and make it available as __wrapped__
+    return functools.update_wrapper(getinstance, cls, updated=())
 
 #------------------------------------------------------------------------
 # Helper methods to save instantiating an object when making calls.
@@ -69,6 +219,9 @@ def query(*args, **kwargs):
 def cmd(*args, **kwargs):
     Query().cmd(*args, **kwargs)
 
+def cmd_many(*args, **kwargs):
+    Query().cmd_many(*args, **kwargs)
+
 @singleton
 class Query(LoggingObject):
     """ Object responsible for passing OSC queries to the LiveOSC server,
@@ -81,9 +234,20 @@ class Query(LoggingObject):
 
         live.query(path, *args)
         live.cmd(path, *args)
+        live.cmd_many([(path, args), ...])
     """
 
-    def __init__(self, address=("127.0.0.1", 9900), listen_port=9002):
+    def __init__(self, address=("127.0.0.1", 9900), listen_port=9002,
+                 recv_buffer=SOCKET_BUFFER_SIZE, send_buffer=SOCKET_BUFFER_SIZE):
+        """ recv_buffer and send_buffer set the size in bytes of the OSC
+        sockets' kernel buffers (or leave the system default, if None), which
+        absorb bursts of messages. liblo does not expose its sending socket,
+        so send_buffer only applies to the pythonosc backend. """
+        #------------------------------------------------------------------------
+        # The backend module: liblo, or live.pythonosc_backend.
+        #------------------------------------------------------------------------
+        self.osc_module = osc = _load_backend()
+
         self.beat_callback = None
         self.startup_callback = None
         self.listen_port = listen_port
@@ -91,17 +255,44 @@ class Query(LoggingObject):
         #------------------------------------------------------------------------
         # Handler callbacks for particular messages from Live.
         # Used so that other processes can register callbacks when states change.
+        #
+        # Handlers added with weak=True are held in weak_handlers, as weak
+        # references. Lists are replaced rather than modified, so handler()
+        # can iterate them without locking.
         #------------------------------------------------------------------------
         self.handlers = {}
+        self.weak_handlers = {}
+        self.handlers_lock = threading.RLock()
+
+        #------------------------------------------------------------------------
+        # Internal handlers for messages that Query itself responds to.
+        #------------------------------------------------------------------------
+        self._address_dispatch = {
+            "/live/beat": self.beat_handler,
+            "/remix/oscserver/startup": self.startup_handler
+        }
 
         self.osc_address = address
         if OSC_BACKEND == 'liblo':
-            self.osc_target = liblo.Address(address[0], address[1])
-            self.osc_server = liblo.Server(listen_port)
+            self.osc_target = osc.Address(address[0], address[1])
+            self.osc_server = osc.Server(listen_port)
             self.osc_server.add_method(None, None, self.handler)
-            self.osc_server.add_bundle_handlers(
-                self.start_bundle_handler, self.end_bundle_handler
-            )
+            # The bundle handlers only log, so don't have liblo call into
+            # Python at every bundle boundary unless that will be output.
+            if logger.isEnabledFor(logging.DEBUG):
+                self.osc_server.add_bundle_handlers(
+                    self.start_bundle_handler, self.end_bundle_handler
+                )
+            self.osc_send = self.liblo_send
+            self.osc_send_bundle = self.liblo_send_bundle
+            self.osc_send_prepared = self.liblo_send_prepared
+
+            if recv_buffer:
+                # fromfd() duplicates the descriptor, but the option applies
+                # to the underlying socket
+                with socket.fromfd(self.osc_server.fileno(), socket.AF_INET,
+                                   socket.SOCK_DGRAM) as sock:
+                    self._set_socket_buffer(sock, socket.SO_RCVBUF, recv_buffer)
 
         elif OSC_BACKEND == 'pythonosc':
             # TODO how to deal w/ bundles? even necessary?
@@ -109,9 +300,12 @@ class Query(LoggingObject):
             # (i think only some of the clip code refers to bundles at all)
 
             ip = address[0]
-            self.osc_client = SimpleUDPClient(ip, address[1])
+            self.osc_client = osc.ConnectedUDPClient(ip, address[1])
+            self.osc_send = self.pythonosc_send
+            self.osc_send_bundle = self.pythonosc_send_bundle
+            self.osc_send_prepared = self.pythonosc_send_prepared
 
-            self.dispatcher = Dispatcher()
+            self.dispatcher = osc.DefaultHandlerDispatcher()
             self.dispatcher.set_default_handler(self.pythonosc_handler_wrapper)
 
             # TODO TODO may need to take more care that this, or the other
@@ -120,30 +314,80 @@ class Query(LoggingObject):
             # for some reason, maybe most likely something else, there seem to
             # be less frequent apparent "connection" issues with liblo than with
             # pythonosc...
-            self.osc_server = ThreadingOSCUDPServer((ip, listen_port),
+            #
+            # BlockingOSCUDPServer handles each message on the server thread,
+            # in order, as with liblo, rather than spawning a thread for each.
+            self.osc_server = osc.BlockingOSCUDPServer((ip, listen_port),
                 self.dispatcher
             )
 
+            if recv_buffer:
+                self._set_socket_buffer(self.osc_server.socket, socket.SO_RCVBUF, recv_buffer)
+            if send_buffer:
+                self._set_socket_buffer(self.osc_client._sock, socket.SO_SNDBUF, send_buffer)
+
         self.osc_server_thread = None
+        self.osc_server_stop = threading.Event()
+
+        #------------------------------------------------------------------------
+        # Callbacks for received messages are run on handler_thread, which
+        # takes them from this queue.
+        #------------------------------------------------------------------------
+        self.handler_thread = None
+        self.handler_queue = queue.SimpleQueue()
 
         self.osc_read_event = None
         self.osc_timeout = 3.0
 
-        self.osc_server_events = {}
+        #------------------------------------------------------------------------
+        # Queries awaiting a response, keyed by response address. Each entry
+        # holds a lock (so that only one query per address is in flight), an
+        # Event to wake the querying thread, the list of returned values
+        # (None when no query is waiting), and the number of threads using it.
+        #------------------------------------------------------------------------
+        self._pending = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
 
-        self.query_address = None
-        self.query_rv = []
+        #------------------------------------------------------------------------
+        # While batching, cmd() queues its messages here instead of
+        # sending them, and they are sent together as an OSC bundle. This is
+        # per-thread, so each thread only batches its own commands.
+        #------------------------------------------------------------------------
+        self._bundle = _BundleState()
+
+        #------------------------------------------------------------------------
+        # Last args sent with dedup and last send time for each address, and
+        # per-address minimum send intervals, used by cmd() to drop redundant
+        # messages. These only hold addresses which use those options.
+        #------------------------------------------------------------------------
+        self._last_sent = {}
+        self._last_sent_time = {}
+        self._min_interval = {}
 
         self.listen()
 
     def osc_server_read(self):
-        assert OSC_BACKEND == 'liblo'
-        while True:
-            self.osc_server.recv(10)
+        #------------------------------------------------------------------------
+        # Block until the server socket is readable, rather than waking up
+        # every few ms to poll it. stop() interrupts the wait by writing to
+        # osc_server_wakeup.
+        #------------------------------------------------------------------------
+        while not self.osc_server_stop.is_set():
+            readable, _, _ = select.select(
+                [self.osc_server, self.osc_server_wakeup_reader], [], []
+            )
+            #------------------------------------------------------------------------
+            # Handle every message already queued before waiting again, so a
+            # burst of messages costs one wakeup rather than one per message.
+            #------------------------------------------------------------------------
+            if self.osc_server in readable:
+                while self.osc_server.recv(0):
+                    pass
 
     def listen(self):
         if OSC_BACKEND == 'liblo':
             target = self.osc_server_read
+            self.osc_server_wakeup_reader, self.osc_server_wakeup = socket.socketpair()
         elif OSC_BACKEND == 'pythonosc':
             target = self.osc_server.serve_forever
 
@@ -151,27 +395,112 @@ class Query(LoggingObject):
         self.osc_server_thread.setDaemon(True)
         self.osc_server_thread.start()
 
+        self.handler_thread = threading.Thread(target=self.handler_thread_run)
+        self.handler_thread.setDaemon(True)
+        self.handler_thread.start()
+
+    def _set_socket_buffer(self, sock, option, size):
+        # The kernel may cap the size (eg at net.core.rmem_max on Linux)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError as e:
+            self.log_warn("Couldn't set socket buffer size to %d: %s", size, e)
+
+    @property
+    def beat_callback(self):
+        return self._beat_callback
+
+    @beat_callback.setter
+    def beat_callback(self, callback):
+        #------------------------------------------------------------------------
+        # Callbacks may take one argument: the current beat count.
+        # If not specified, call with 0 arguments. Inspect the signature once
+        # here, rather than on every beat.
+        #------------------------------------------------------------------------
+        has_arg = False
+        if callback is not None:
+            try:
+                has_arg = len(inspect.signature(callback).parameters) > 0
+            except (TypeError, ValueError):
+                pass
+        if callback is None or has_arg:
+            self._beat_dispatch = callback
+        else:
+            self._beat_dispatch = lambda beat: callback()
+        self._beat_callback = callback
+
     def stop(self):
         """ Terminate this query object and unbind from OSC listening. """
-        pass
+        if self.osc_server_thread is None:
+            return
 
-    def cmd(self, msg, *args):
+        self.osc_server_stop.set()
+        if OSC_BACKEND == 'liblo':
+            self.osc_server_wakeup.send(b"\0")
+            self.osc_server_thread.join()
+            self.osc_server_wakeup.close()
+            self.osc_server_wakeup_reader.close()
+            self.osc_server.free()
+        elif OSC_BACKEND == 'pythonosc':
+            self.osc_server.shutdown()
+            self.osc_server_thread.join()
+            self.osc_server.server_close()
+
+        self.osc_server_thread = None
+
+        self.handler_queue.put(None)
+        if threading.current_thread() is not self.handler_thread:
+            self.handler_thread.join()
+        self.handler_thread = None
+
+    def cmd(self, msg, *args, dedup=False, min_interval=None):
         """ Send a Live command without expecting a response back:
 
-            live.cmd("/live/tempo", 110.0) """
-        
+            live.cmd("/live/tempo", 110.0)
+
+        If dedup is True, the command is not sent if its args have the same
+        values and types as the last ones sent to this address with dedup.
+        If min_interval is given (or a rate limit has been set with
+        set_rate_limit()), the command is dropped if the last one sent to
+        this address was less than min_interval seconds ago. """
+
+        if dedup:
+            # compare types too, so that eg 1 and 1.0 are not treated as equal
+            sent = (args, tuple(map(type, args)))
+            if self._last_sent.get(msg) == sent:
+                return
+
+        if min_interval is None and self._min_interval:
+            min_interval = self._min_interval.get(msg)
+        now = None
+        if min_interval is not None:
+            now = time.monotonic()
+            last_time = self._last_sent_time.get(msg)
+            if last_time is not None and now - last_time < min_interval:
+                return
+
+        self._send(msg, args)
+
+        #------------------------------------------------------------------------
+        # Only record the command once it has been sent (or queued), so that a
+        # failed send can be retried.
+        #------------------------------------------------------------------------
+        if dedup:
+            self._last_sent[msg] = sent
+        if now is not None:
+            self._last_sent_time[msg] = now
+
+    def _send(self, msg, args):
+        """ Send (or, while batching, queue) a command, without cmd()'s dedup
+        and rate limiting. """
         self.log_debug("OSC output: %s %s", msg, args)
-        try:
-            if OSC_BACKEND == 'liblo':
-                liblo.send(self.osc_target, msg, *args)
 
-            elif OSC_BACKEND == 'pythonosc':
-                # not clear on whether this unpacking in len(1) case in
-                # necessary, just trying to make it look like examples in docs
-                if len(args) == 1:
-                    args = args[0]
+        if self._bundle.messages is not None:
+            self._add_to_bundle(msg, args)
+            return
 
-                self.osc_client.send_message(msg, args)
+        try:
+            self.osc_send(msg, args)
     
         # TODO TODO need to modify pythonosc client call / handling so it will
         # also raise an error in this case? (probably)
@@ -179,6 +508,105 @@ class Query(LoggingObject):
             self.log_debug(f"During cmd({msg}, {args})")
             raise LiveConnectionError("Couldn't send message to Live (is LiveOSC present and activated?)")
 
+    def set_rate_limit(self, address, hz):
+        """ Send at most hz commands per second to address, dropping any
+        others. Pass hz=None to remove the limit. """
+        if hz:
+            self._min_interval[address] = 1.0 / hz
+        else:
+            self._min_interval.pop(address, None)
+
+    def prepare(self, msg, typetags=""):
+        """ Create a PreparedCommand for sending msg with arguments of the
+        given OSC types (any of "i", "f", "d", "h"):
+
+            set_tempo = live.Query().prepare("/live/tempo", "f")
+            set_tempo(110.0) """
+        return PreparedCommand(self, msg, typetags)
+
+    def cmd_many(self, messages):
+        """ Send a list of Live commands, packed into as few OSC bundles
+        as possible:
+
+            live.cmd_many([("/live/tempo", (110.0,)), ("/live/play", ())]) """
+
+        batching = self._bundle.messages is not None
+        self.begin_bundle()
+        try:
+            for msg, args in messages:
+                self.cmd(msg, *args)
+        finally:
+            if not batching:
+                self.end_bundle()
+
+    #------------------------------------------------------------------------
+    # Bundling: queue up commands and send them together as one OSC bundle,
+    # rather than one UDP packet per message.
+    #
+    # Batching is per-thread: commands sent from other threads while one
+    # thread is batching are sent as normal.
+    #------------------------------------------------------------------------
+
+    def begin_bundle(self):
+        """ Start queueing commands sent via cmd() by this thread rather than
+        sending them immediately. They are sent when end_bundle() is called,
+        or earlier if the bundle grows beyond BUNDLE_MAX_SIZE bytes. """
+        bundle = self._bundle
+        if bundle.messages is None:
+            bundle.messages = []
+            bundle.size = BUNDLE_HEADER_SIZE
+
+    def end_bundle(self):
+        """ Send any queued commands and stop bundling. """
+        try:
+            self.flush_bundle()
+        finally:
+            self._bundle.messages = None
+
+    @contextlib.contextmanager
+    def batched(self):
+        """ Context manager which bundles all commands sent within it:
+
+            with live.Query().batched():
+                live.cmd("/live/tempo", 110.0)
+                live.cmd("/live/play") """
+        batching = self._bundle.messages is not None
+        self.begin_bundle()
+        try:
+            yield self
+        finally:
+            if not batching:
+                self.end_bundle()
+
+    def _add_to_bundle(self, msg, args, typetags=None, size=None):
+        # bundle elements are each prefixed by a 4-byte size
+        if size is None:
+            size = _osc_message_size(msg, args)
+        size += 4
+        bundle = self._bundle
+        if bundle.messages and bundle.size + size > BUNDLE_MAX_SIZE:
+            self.flush_bundle()
+        bundle.messages.append((msg, args, typetags))
+        bundle.size += size
+
+    def flush_bundle(self):
+        """ Send any commands queued since begin_bundle() as a single OSC
+        bundle. """
+        bundle = self._bundle
+        messages = bundle.messages
+        if not messages:
+            return
+
+        bundle.messages = []
+        bundle.size = BUNDLE_HEADER_SIZE
+
+        try:
+            self.osc_send_bundle(messages)
+
+        except Exception as e:
+            self.log_debug(f"During flush_bundle({messages})")
+            raise LiveConnectionError("Couldn't send message to Live (is LiveOSC present and activated?)")
+
 
     # TODO maybe compute something like the average latency for a response to
     # arrive for a query (maybe weighted by recency) for debugging whether the
@@ -208,103 +636,250 @@ class Query(LoggingObject):
         #------------------------------------------------------------------------
         response_address = kwargs.get("response_address", None)
         if response_address:
-            response_address = response_address
+            response_address = sys.intern(response_address)
         else:
-            response_address = msg
+            response_address = sys.intern(msg)
 
-        #------------------------------------------------------------------------
-        # Create an Event to block the thread until this response has been
-        # triggered.
-        #------------------------------------------------------------------------
-        self.osc_server_events[response_address] = threading.Event()
+        timeout = kwargs.get("timeout", self.osc_timeout)
 
-        #------------------------------------------------------------------------
-        # query_rv will be populated by the callback, storing the return value
-        # of the OSC query.
-        #------------------------------------------------------------------------
-        self.query_address = response_address
-        self.query_rv = []
-        self.cmd(msg, *args)
+        with self._pending_lock:
+            entry = self._pending.get(response_address)
+            if entry is None:
+                entry = self._pending[response_address] = {
+                    "lock": threading.Lock(),
+                    "event": threading.Event(),
+                    "rv": None,
+                    "users": 0
+                }
+            else:
+                self._pending.move_to_end(response_address)
+            entry["users"] += 1
+            if len(self._pending) > PENDING_MAX_SIZE:
+                self._evict_pending()
 
         #------------------------------------------------------------------------
-        # Wait for a response. 
+        # Queries to different response addresses can run concurrently, but
+        # responses to the same address can't be told apart, so those are
+        # serialised.
         #------------------------------------------------------------------------
-        timeout = kwargs.get("timeout", self.osc_timeout)
-        rv = self.osc_server_events[response_address].wait(timeout)
+        with entry["lock"]:
+            #------------------------------------------------------------------------
+            # rv will be populated by the callback, storing the return value
+            # of the OSC query.
+            #------------------------------------------------------------------------
+            entry["event"].clear()
+            entry["rv"] = []
+            try:
+                # bypass cmd()'s dedup and rate limiting, which would
+                # leave the query waiting for a response that never comes
+                self._send(msg, args)
+
+                #------------------------------------------------------------------------
+                # If commands are being bundled, send the query now, or we would
+                # wait for a response to a message that has not been sent yet.
+                #------------------------------------------------------------------------
+                self.flush_bundle()
 
-        if not rv:
+                #------------------------------------------------------------------------
+                # Wait for a response. 
+                #------------------------------------------------------------------------
+                responded = entry["event"].wait(timeout)
+            finally:
+                rv = entry["rv"]
+                entry["rv"] = None
+                with self._pending_lock:
+                    entry["users"] -= 1
+
+        if not responded:
             self.log_debug(f"Timeout during query({msg}, {args}, {kwargs})")
             # TODO could change error message to not question whether LiveOSC
             # is setup correctly if there has been any successful communication
             # so far...
             raise LiveConnectionError("Timed out waiting for response from LiveOSC. Is Live running and LiveOSC installed?")
 
-        return self.query_rv
+        return rv
+
+    def _evict_pending(self):
+        """ Discard the least recently used entries in _pending that no
+        query is using, until it is back within PENDING_MAX_SIZE. Must be
+        called with _pending_lock held. """
+        excess = len(self._pending) - PENDING_MAX_SIZE
+        for address in [address for address, entry in self._pending.items()
+                        if entry["users"] == 0][:excess]:
+            del self._pending[address]
+
+    #------------------------------------------------------------------------
+    # Backend-specific methods. __init__ binds the ones for the active
+    # backend, so there is no need to check OSC_BACKEND on each message.
+    #------------------------------------------------------------------------
+
+    def liblo_send(self, msg, args):
+        self.osc_module.send(self.osc_target, msg, *args)
+
+    def liblo_send_bundle(self, messages):
+        liblo = self.osc_module
+        bundle = liblo.Bundle(*[
+            liblo.Message(msg, *(args if typetags is None else zip(typetags, args)))
+            for msg, args, typetags in messages
+        ])
+        liblo.send(self.osc_target, bundle)
+
+    def liblo_send_prepared(self, command, args, dgram):
+        # pyliblo can't reuse a Message with new args, but passing explicit
+        # (type, value) pairs at least skips its type inference
+        self.osc_module.send(self.osc_target, command.msg, *zip(command.typetags, args))
+
+    def pythonosc_send(self, msg, args):
+        # not clear on whether this unpacking in len(1) case in
+        # necessary, just trying to make it look like examples in docs
+        if len(args) == 1:
+            args = args[0]
+
+        self.osc_client.send_message(msg, args)
+
+    def pythonosc_send_bundle(self, messages):
+        pythonosc = self.osc_module
+        builder = pythonosc.OscBundleBuilder(pythonosc.IMMEDIATELY)
+        for msg, args, typetags in messages:
+            message = pythonosc.OscMessageBuilder(address=msg)
+            if typetags is None:
+                for arg in args:
+                    message.add_arg(arg)
+            else:
+                for arg, typetag in zip(args, typetags):
+                    message.add_arg(arg, typetag)
+            builder.add_content(message.build())
+        self.osc_client.send(builder.build())
+
+    def pythonosc_send_prepared(self, command, args, dgram):
+        self.osc_client.send_dgram(dgram)
 
     # TODO maybe pythonosc.osc_bundle_builder / osc_message_builder could
     # replace some of what these are doing (in OSC_BACKEND == 'pythonosc' case)?
     # (though not clear these are critical...)
     def start_bundle_handler(self, *args):
-        assert OSC_BACKEND == 'liblo'
         self.log_debug("OSC: start bundle")
 
     def end_bundle_handler(self, *args):
-        assert OSC_BACKEND == 'liblo'
         self.log_debug("OSC: end bundle")
 
     def pythonosc_handler_wrapper(self, address, *args):
-        assert OSC_BACKEND == 'pythonosc'
         # TODO may need to unwrap len(args) == 0 case or something like that
         self.handler(address, args, None)
 
     def handler(self, address, data, types):
-        self.log_debug("OSC input: %s %s" % (address, data))
-
         #------------------------------------------------------------------------
-        # Execute any callbacks that have been registered for this message
+        # Addresses come from a small, fixed set, so interning them lets the
+        # dict lookups below match keys by identity.
         #------------------------------------------------------------------------
-        if address in self.handlers:
-            for handler in self.handlers[address]:
-                handler(*data)
+        address = sys.intern(address)
+        self.log_debug("OSC input: %s %s", address, data)
+
+        handlers = self.handlers.get(address)
+        weak_handlers = self.weak_handlers.get(address)
+        fn = self._address_dispatch.get(address)
 
         #------------------------------------------------------------------------
         # If this message is awaiting a synchronous return, trigger the
-        # thread event and update our return value. 
+        # thread event and update our return value. This is done here rather
+        # than on the handler thread, so that slow callbacks can't delay it.
         #------------------------------------------------------------------------
-        if address == self.query_address:
-            self.query_rv += data
-            self.osc_server_events[address].set()
-            return
+        entry = self._pending.get(address)
+        if entry is not None:
+            rv = entry["rv"]
+            if rv is not None:
+                rv.extend(data)
+                entry["event"].set()
+                fn = None
 
-        if address == "/live/beat":
-            if self.beat_callback is not None:
-                #------------------------------------------------------------------------
-                # Beat callbacks are used if we want to trigger an event on each beat,
-                # to synchronise with the timing of the Live set.
-                #
-                # Callbacks may take one argument: the current beat count.
-                # If not specified, call with 0 arguments.
-                #------------------------------------------------------------------------
-                has_arg = False
-                try:
-                    signature = inspect.signature(self.beat_callback)
-                    has_arg = len(signature.parameters) > 0
-                except:
-                    # Python 2
-                    argspec = inspect.getargspec(self.beat_callback)
-                    has_arg = len(argspec.args) > 0 and argspec.args[-1] != "self"
-
-                if has_arg:
-                    self.beat_callback(data[0])
-                else:
-                    self.beat_callback()
+        #------------------------------------------------------------------------
+        # Execute any callbacks that have been registered for this message
+        # on the handler thread, so that the OSC server can keep receiving
+        # while they run.
+        #------------------------------------------------------------------------
+        if handlers or weak_handlers or fn is not None:
+            self.handler_queue.put((address, data, handlers, weak_handlers, fn))
 
-        elif address == "/remix/oscserver/startup":
-            if self.startup_callback is not None:
-                self.startup_callback()
+    def handler_thread_run(self):
+        while True:
+            item = self.handler_queue.get()
+            if item is None:
+                return
+
+            address, data, handlers, weak_handlers, fn = item
+            if handlers:
+                for handler in handlers:
+                    self._run_handler(address, handler, *data)
+            if weak_handlers:
+                for ref in weak_handlers:
+                    handler = ref()
+                    if handler is not None:
+                        self._run_handler(address, handler, *data)
+            if fn is not None:
+                self._run_handler(address, fn, data)
+            #------------------------------------------------------------------------
+            # Don't keep the last handler alive while waiting for the next item.
+            #------------------------------------------------------------------------
+            item = handler = None
+
+    def _run_handler(self, address, handler, *args):
+        # each callback is isolated, so one raising doesn't skip the others
+        try:
+            handler(*args)
+        except Exception:
+            logger.exception("[%s] Exception in handler for %s", self, address)
 
-    def add_handler(self, address, handler):
-        if not address in self.handlers:
-            self.handlers[address] = []
-        self.handlers[address].append(handler)
+    def beat_handler(self, data):
+        #------------------------------------------------------------------------
+        # Beat callbacks are used if we want to trigger an event on each beat,
+        # to synchronise with the timing of the Live set.
+        #------------------------------------------------------------------------
+        dispatch = self._beat_dispatch
+        if dispatch is not None:
+            dispatch(data[0])
+
+    def startup_handler(self, data):
+        if self.startup_callback is not None:
+            self.startup_callback()
+
+    def add_handler(self, address, handler, weak=False):
+        """ Call handler with the arguments of each message received at
+        address. If weak is True, only a weak reference to handler is kept,
+        so registering a bound method does not keep its object alive; it is
+        removed once the object is deleted. """
+        address = sys.intern(address)
+        with self.handlers_lock:
+            if weak:
+                callback = lambda ref: self._remove_handler(self.weak_handlers, address, ref)
+                if inspect.ismethod(handler):
+                    ref = weakref.WeakMethod(handler, callback)
+                else:
+                    ref = weakref.ref(handler, callback)
+                self.weak_handlers[address] = self.weak_handlers.get(address, []) + [ref]
+            else:
+                self.handlers[address] = self.handlers.get(address, []) + [handler]
+
+    def remove_handler(self, address, handler):
+        """ Stop calling a handler previously registered with add_handler(). """
+        for other in self.handlers.get(address, []):
+            if other == handler:
+                self._remove_handler(self.handlers, address, other)
+                return
+        for ref in self.weak_handlers.get(address, []):
+            if ref() == handler:
+                self._remove_handler(self.weak_handlers, address, ref)
+                return
+        raise ValueError("Handler not registered for %s: %s" % (address, handler))
+
+    def _remove_handler(self, table, address, handler):
+        with self.handlers_lock:
+            handlers = table.get(address, [])
+            for index, other in enumerate(handlers):
+                if other is handler:
+                    handlers = handlers[:index] + handlers[index + 1:]
+                    break
+            if handlers:
+                table[address] = handlers
+            else:
+                table.pop(address, None)
 
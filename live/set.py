@@ -931,8 +931,11 @@ class Set(LoggingObject):
         self._startup_event = None
 
     def _add_handlers(self):
-        self.live.add_handler("/live/clip/info", self._update_clip_state)
-        self.live.add_handler("/live/tempo", self._update_tempo)
+        #------------------------------------------------------------------------
+        # Held weakly, so that Query doesn't keep every Set created alive.
+        #------------------------------------------------------------------------
+        self.live.add_handler("/live/clip/info", self._update_clip_state, weak=True)
+        self.live.add_handler("/live/tempo", self._update_tempo, weak=True)
 
     def _update_tempo(self, tempo):
         self.set_tempo(tempo, cache_only = True)
@@ -0,0 +1,409 @@
+""" Unit tests for live.Query which do not need a running Live set.
+
+A loopback UDP socket stands in for LiveOSC, echoing each datagram it
+receives back to the Query, so that queries are answered with the
+values they were sent. """
+
+import pytest
+import socket
+import struct
+import threading
+import time
+import live
+
+from live.exceptions import LiveConnectionError
+from live.query import singleton, _load_backend, _osc_message_size, BUNDLE_MAX_SIZE
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def bundle_elements(dgram):
+    """ Split an OSC bundle into the datagrams of its elements. """
+    assert dgram.startswith(b"#bundle\0")
+    elements = []
+    index = 16
+    while index < len(dgram):
+        size, = struct.unpack(">i", dgram[index:index + 4])
+        elements.append(dgram[index + 4:index + 4 + size])
+        index += 4 + size
+    return elements
+
+def osc_address(dgram):
+    return dgram[:dgram.index(b"\0")].decode()
+
+class EchoServer(object):
+    """ Records each datagram received, and sends it back to reply_port. """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.reply_port = None
+        self.dgrams = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                dgram = self.socket.recv(65536)
+            except OSError:
+                return
+            self.dgrams.append(dgram)
+            if self.reply_port:
+                self.socket.sendto(dgram, ("127.0.0.1", self.reply_port))
+
+    def messages(self):
+        """ Every message received, with bundles unpacked. """
+        messages = []
+        for dgram in list(self.dgrams):
+            if dgram.startswith(b"#bundle\0"):
+                messages += bundle_elements(dgram)
+            else:
+                messages.append(dgram)
+        return messages
+
+    def close(self):
+        self.socket.close()
+
+@pytest.fixture
+def echo():
+    server = EchoServer()
+    yield server
+    server.close()
+
+@pytest.fixture
+def query(echo):
+    try:
+        _load_backend()
+    except ImportError:
+        pytest.skip("no OSC backend available")
+
+    echo.reply_port = free_port()
+    query = live.Query.__wrapped__(address=("127.0.0.1", echo.port),
+                                   listen_port=echo.reply_port)
+    yield query
+    query.stop()
+
+#------------------------------------------------------------------------
+# Batching
+#------------------------------------------------------------------------
+
+def test_batched_sends_one_bundle(query, echo):
+    with query.batched():
+        query.cmd("/test/a", 1)
+        query.cmd("/test/b", 2.5)
+        query.cmd("/test/c", "three")
+        time.sleep(0.1)
+        assert echo.dgrams == []
+
+    assert wait_until(lambda: len(echo.dgrams) == 1)
+    elements = bundle_elements(echo.dgrams[0])
+    assert [osc_address(element) for element in elements] == ["/test/a", "/test/b", "/test/c"]
+
+def test_bundles_split_at_max_size(query, echo):
+    messages = [("/test/%d" % index, (index, 1 << 40, "x" * (index % 30), 0.5))
+                for index in range(300)]
+    query.cmd_many(messages)
+
+    assert wait_until(lambda: len(echo.messages()) == 300)
+    assert len(echo.dgrams) > 1
+    for dgram in echo.dgrams:
+        assert len(dgram) <= BUNDLE_MAX_SIZE
+    assert [osc_address(message) for message in echo.messages()] == [msg for msg, args in messages]
+
+@pytest.mark.parametrize("args", [
+    (), (1,), (1 << 40,), (-(1 << 31),), (0.5,), ("",), ("abc",), ("abcd",), (b"xyz",),
+    (1, 2.0, "three", 1 << 33)
+])
+def test_message_size_estimate(query, echo, args):
+    query.cmd_many([("/test/size", args)])
+    assert wait_until(lambda: len(echo.dgrams) == 1)
+    element, = bundle_elements(echo.dgrams[0])
+    assert len(element) == _osc_message_size("/test/size", args)
+
+def test_batching_is_per_thread(query, echo):
+    with query.batched():
+        query.cmd("/test/main", 1)
+        thread = threading.Thread(target=query.cmd, args=("/test/other", 2))
+        thread.start()
+        thread.join()
+        assert wait_until(lambda: len(echo.dgrams) == 1)
+        assert osc_address(echo.dgrams[0]) == "/test/other"
+
+    assert wait_until(lambda: len(echo.dgrams) == 2)
+    assert [osc_address(element) for element in bundle_elements(echo.dgrams[1])] == ["/test/main"]
+
+def test_query_inside_batch_is_sent(query, echo):
+    with query.batched():
+        query.cmd("/test/before", 1)
+        assert query.query("/test/query", 7, timeout=1.0) == [7]
+
+def test_failed_flush_ends_batch(query, echo, monkeypatch):
+    def fail(messages):
+        raise OSError("send failed")
+    monkeypatch.setattr(query, "osc_send_bundle", fail)
+
+    with pytest.raises(LiveConnectionError):
+        with query.batched():
+            query.cmd("/test/a", 1)
+    assert query._bundle.messages is None
+
+    query.cmd("/test/b", 2)
+    assert wait_until(lambda: len(echo.dgrams) == 1)
+    assert osc_address(echo.dgrams[0]) == "/test/b"
+
+#------------------------------------------------------------------------
+# singleton
+#------------------------------------------------------------------------
+
+def test_singleton_passes_kwargs():
+    @singleton
+    class Thing(object):
+        def __init__(self, a, b=1):
+            self.a = a
+            self.b = b
+
+    thing = Thing(2, b=3)
+    assert (thing.a, thing.b) == (2, 3)
+    assert Thing() is thing
+
+def test_singleton_creates_one_instance_across_threads():
+    created = []
+    barrier = threading.Barrier(8)
+
+    @singleton
+    class Thing(object):
+        def __init__(self):
+            created.append(self)
+
+    results = []
+    def get_thing():
+        barrier.wait()
+        results.append(Thing())
+
+    threads = [threading.Thread(target=get_thing) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert all(result is created[0] for result in results)
+
+def test_singleton_wraps_class():
+    assert live.Query.__wrapped__.__name__ == "Query"
+    assert live.Query.__doc__ == live.Query.__wrapped__.__doc__
+
+#------------------------------------------------------------------------
+# Dedup and rate limiting
+#------------------------------------------------------------------------
+
+def test_cmd_dedup(query, echo):
+    query.cmd("/test/dedup", 1, dedup=True)
+    query.cmd("/test/dedup", 1, dedup=True)
+    query.cmd("/test/dedup", 2, dedup=True)
+    query.cmd("/test/dedup", 2)
+    assert wait_until(lambda: len(echo.dgrams) == 3)
+    time.sleep(0.1)
+    assert len(echo.dgrams) == 3
+
+def test_cmd_dedup_compares_types(query, echo):
+    query.cmd("/test/dedup", 1, dedup=True)
+    query.cmd("/test/dedup", 1.0, dedup=True)
+    query.cmd("/test/dedup", True, dedup=True)
+    query.cmd("/test/dedup", True, dedup=True)
+    assert wait_until(lambda: len(echo.dgrams) == 3)
+    time.sleep(0.1)
+    assert len(echo.dgrams) == 3
+
+def test_cmd_only_records_deduped_args(query, echo):
+    query.cmd("/test/plain", 1)
+    query.cmd("/test/plain", 1, dedup=True)
+    assert query._last_sent.keys() == {"/test/plain"}
+    query.cmd("/test/other", 1)
+    assert query._last_sent.keys() == {"/test/plain"}
+    assert wait_until(lambda: len(echo.dgrams) == 3)
+
+def test_cmd_min_interval(query, echo):
+    query.cmd("/test/interval", 1, min_interval=0.2)
+    query.cmd("/test/interval", 2, min_interval=0.2)
+    time.sleep(0.25)
+    query.cmd("/test/interval", 3, min_interval=0.2)
+    assert wait_until(lambda: len(echo.dgrams) == 2)
+    time.sleep(0.1)
+    assert len(echo.dgrams) == 2
+
+def test_set_rate_limit(query, echo):
+    query.set_rate_limit("/test/rate", 5)
+    for value in range(10):
+        query.cmd("/test/rate", value)
+    query.set_rate_limit("/test/rate", None)
+    query.cmd("/test/rate", 10)
+    assert wait_until(lambda: len(echo.dgrams) == 2)
+    time.sleep(0.1)
+    assert len(echo.dgrams) == 2
+
+def test_query_bypasses_rate_limit(query, echo):
+    query.set_rate_limit("/test/limited", 1)
+    assert query.query("/test/limited", 1, timeout=1.0) == [1]
+    assert query.query("/test/limited", 2, timeout=1.0) == [2]
+
+#------------------------------------------------------------------------
+# Prepared commands
+#------------------------------------------------------------------------
+
+def test_prepared_command_encoding(query, echo):
+    set_tempo = query.prepare("/test/tempo", "f")
+    set_tempo(110.0)
+    set_tempo(111.5)
+    mixed = query.prepare("/test/mixed", "ifdh")
+    mixed(3, 1.5, 2.25, 1 << 40)
+
+    assert wait_until(lambda: len(echo.dgrams) == 3)
+    assert echo.dgrams == [
+        b"/test/tempo\0,f\0\0" + struct.pack(">f", 110.0),
+        b"/test/tempo\0,f\0\0" + struct.pack(">f", 111.5),
+        b"/test/mixed\0,ifdh\0\0\0" + struct.pack(">ifdq", 3, 1.5, 2.25, 1 << 40)
+    ]
+
+def test_prepared_command_without_args(query, echo):
+    query.prepare("/test/none")()
+    assert wait_until(lambda: len(echo.dgrams) == 1)
+    assert echo.dgrams == [b"/test/none\0\0,\0\0\0"]
+
+def test_prepared_command_checks_arg_count(query):
+    set_tempo = query.prepare("/test/tempo", "f")
+    with pytest.raises(TypeError):
+        set_tempo()
+    with pytest.raises(TypeError):
+        set_tempo(1.0, 2.0)
+
+def test_prepared_command_checks_arg_types(query, echo):
+    set_count = query.prepare("/test/count", "i")
+    with pytest.raises(struct.error):
+        set_count(1.5)
+    with query.batched():
+        with pytest.raises(struct.error):
+            set_count("one")
+    time.sleep(0.1)
+    assert echo.dgrams == []
+
+def test_prepared_command_rejects_variable_size_types(query):
+    with pytest.raises(ValueError):
+        query.prepare("/test/name", "s")
+
+def test_prepared_command_batched_ignores_rate_limit(query, echo):
+    query.set_rate_limit("/test/tempo", 1)
+    set_tempo = query.prepare("/test/tempo", "f")
+    with query.batched():
+        set_tempo(1.0)
+        set_tempo(2.0)
+    assert wait_until(lambda: len(echo.messages()) == 2)
+
+def test_prepared_command_batched_keeps_types(query, echo):
+    mixed = query.prepare("/test/mixed", "ifdh")
+    with query.batched():
+        mixed(3, 1, 2, 4)
+    assert wait_until(lambda: len(echo.dgrams) == 1)
+    assert bundle_elements(echo.dgrams[0]) == [
+        b"/test/mixed\0,ifdh\0\0\0" + struct.pack(">ifdq", 3, 1, 2, 4)
+    ]
+
+#------------------------------------------------------------------------
+# Handlers
+#------------------------------------------------------------------------
+
+class Listener(object):
+    def __init__(self):
+        self.received = []
+
+    def on_message(self, *args):
+        self.received.append(args)
+
+def test_add_handler_keeps_bound_method(query):
+    received = []
+    class Temporary(object):
+        def on_message(self, *args):
+            received.append(args)
+
+    query.add_handler("/test/handler", Temporary().on_message)
+    query.cmd("/test/handler", 1)
+    assert wait_until(lambda: received == [(1,)])
+    assert query.handlers["/test/handler"][0].__func__ is Temporary.on_message
+
+def test_add_handler_weak(query):
+    import gc
+    listener = Listener()
+    query.add_handler("/test/weak", listener.on_message, weak=True)
+    query.cmd("/test/weak", 1)
+    assert wait_until(lambda: listener.received == [(1,)])
+
+    del listener
+    gc.collect()
+    assert "/test/weak" not in query.weak_handlers
+
+def test_remove_handler(query):
+    received = []
+    handler = lambda *args: received.append(args)
+    query.add_handler("/test/remove", handler)
+    query.cmd("/test/remove", 1)
+    assert wait_until(lambda: received == [(1,)])
+
+    query.remove_handler("/test/remove", handler)
+    assert "/test/remove" not in query.handlers
+    query.cmd("/test/remove", 2)
+    time.sleep(0.1)
+    assert received == [(1,)]
+
+    with pytest.raises(ValueError):
+        query.remove_handler("/test/remove", handler)
+
+def test_handlers_run_on_handler_thread(query):
+    threads = []
+    query.add_handler("/test/thread", lambda *args: threads.append(threading.current_thread()))
+    query.cmd("/test/thread", 1)
+    assert wait_until(lambda: threads)
+    assert threads == [query.handler_thread]
+
+def test_failing_handler_does_not_skip_others(query):
+    listener = Listener()
+    received = []
+    def fail(*args):
+        raise RuntimeError("handler failed")
+    query.add_handler("/test/fail", fail)
+    query.add_handler("/test/fail", received.append)
+    query.add_handler("/test/fail", listener.on_message, weak=True)
+    query.cmd("/test/fail", 1)
+    assert wait_until(lambda: received == [1] and listener.received == [(1,)])
+
+def test_handler_can_query(query):
+    #------------------------------------------------------------------------
+    # A handler blocking on query() mustn't stall the receive thread, which
+    # has to deliver the response.
+    #------------------------------------------------------------------------
+    results = []
+    query.add_handler("/test/outer", lambda *args: results.append(query.query("/test/inner", 2)))
+    query.cmd("/test/outer", 1)
+    assert wait_until(lambda: results)
+    assert results == [[2]]
+
+def test_slow_handler_does_not_delay_query(query):
+    release = threading.Event()
+    query.add_handler("/test/slow", lambda *args: release.wait(2.0))
+    query.cmd("/test/slow", 1)
+    try:
+        assert query.query("/test/fast", 3) == [3]
+    finally:
+        release.set()